@@ -61,10 +61,13 @@ Requires:
 """
 
 import argparse
+import io
 import os
-import glob
+from concurrent.futures import ProcessPoolExecutor
+from math import gcd
 import numpy as np
 import soundfile as sf
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.signal import resample_poly
 
 # --- Keep these in sync with firmware ---
@@ -132,28 +135,46 @@ def compute_goertzel_coeffs():
   w = 2.0 * np.cos(2.0*np.pi*k/FRAME_SAMPLES)
   return w.astype(np.float32), freqs
 
-GOERTZEL_W, _ = compute_goertzel_coeffs()
-HANN = hann(FRAME_SAMPLES)
+def compute_dft_basis(freqs):
+  # cos/sin basis [FRAME_SAMPLES, KWS_NBINS] at the exact (non-integer) bin
+  # freqs, so |X|^2 equals the Goertzel power the device computes.
+  n = np.arange(FRAME_SAMPLES, dtype=np.float64)[:, None]
+  phase = 2.0*np.pi*n*freqs[None, :]/KWS_SR
+  return np.cos(phase).astype(np.float32), np.sin(phase).astype(np.float32)
+
+_, BIN_FREQS = compute_goertzel_coeffs()
+DFT_COS, DFT_SIN = compute_dft_basis(BIN_FREQS)
+HANN = hann(FRAME_SAMPLES).astype(np.float32)
+
+# Scratch for the NumPy feature path, reused across WAVs (per process) so each
+# call doesn't allocate fresh [T, FRAME_SAMPLES] temporaries. Grown on demand
+# because the VAD span can exceed KWS_MAX_FRAMES before the final clamp.
+_XW = np.empty((KWS_MAX_FRAMES, FRAME_SAMPLES), dtype=np.float32)
+_RE = np.empty((KWS_MAX_FRAMES, KWS_NBINS), dtype=np.float32)
+_IM = np.empty((KWS_MAX_FRAMES, KWS_NBINS), dtype=np.float32)
+
+def _scratch(T):
+  global _XW, _RE, _IM
+  if T > _XW.shape[0]:
+    _XW = np.empty((T, FRAME_SAMPLES), dtype=np.float32)
+    _RE = np.empty((T, KWS_NBINS), dtype=np.float32)
+    _IM = np.empty((T, KWS_NBINS), dtype=np.float32)
+  return _XW[:T], _RE[:T], _IM[:T]
 
 def mono16k(wav):
-  x, sr = sf.read(wav, always_2d=False)
+  # Read straight to float32 (avoids a float64 temporary).
+  x, sr = sf.read(wav, always_2d=False, dtype="float32")
   # make mono
   if x.ndim == 2:
-    x = x.mean(axis=1)
-  x = x.astype(np.float32)
+    x = x.mean(axis=1, dtype=np.float32)
 
-  # normalize 16-bit range if float
-  # (not strictly needed; we keep amplitude scale similar to device)
-  # resample to 16 kHz
+  # resample to 16 kHz (skipped when the file is already at KWS_SR)
   if sr != KWS_SR:
-    # rational resampler
-    # Find integers p/q approx KWS_SR/sr:
-    # Use resample_poly with simple factors:
-    from math import gcd
+    # rational resampler: up/down = KWS_SR/sr reduced by their gcd
     g = gcd(int(KWS_SR), int(sr))
     up = int(KWS_SR // g)
     down = int(sr // g)
-    x = resample_poly(x, up, down).astype(np.float32)
+    x = resample_poly(x, up, down).astype(np.float32, copy=False)
 
   # Match device pipeline: HPF before VAD/feature extraction.
   x = hpf_1pole(x)
@@ -161,41 +182,54 @@ def mono16k(wav):
   return x
 
 def frame_sig(x):
-  """Return frames [num_frames, FRAME_SAMPLES] with hop HOP_SAMPLES."""
+  """Return frames [num_frames, FRAME_SAMPLES] with hop HOP_SAMPLES.
+
+  The result is a read-only strided view into x (no copy).
+  """
   if len(x) < FRAME_SAMPLES:
     return np.zeros((0, FRAME_SAMPLES), dtype=np.float32)
-  n = 1 + (len(x) - FRAME_SAMPLES) // HOP_SAMPLES
-  idx = np.arange(FRAME_SAMPLES)[None, :] + np.arange(n)[:, None]*HOP_SAMPLES
-  return x[idx].copy()
+  return sliding_window_view(x, FRAME_SAMPLES)[::HOP_SAMPLES]
 
 def vad_mask(frames):
   if len(frames) == 0:
     return np.zeros((0,), dtype=bool)
-  rms = np.sqrt((frames.astype(np.float32)**2).mean(axis=1))
-  zc  = ((frames[:, 1:]*frames[:, :-1]) < 0).sum(axis=1)
+  # Row-wise sum of squares without a [T, FRAME_SAMPLES] temporary.
+  rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / FRAME_SAMPLES)
+  # Zero crossings: sign-bit changes between neighbours (no FP multiplies).
+  sb  = np.signbit(frames)
+  zc  = np.count_nonzero(sb[:, 1:] ^ sb[:, :-1], axis=1)
 
   # ADAPTIVE thresholds (robust for quiet/loud files)
-  rms_on = max(200.0, 0.6 * np.median(rms))        # scale to file loudness
+  # median by direct O(T) selection (same value as np.median, less overhead)
+  mid = rms.size // 2
+  part = np.partition(rms, (max(mid - 1, 0), mid))
+  med = part[mid] if rms.size % 2 else 0.5 * (part[mid - 1] + part[mid])
+  rms_on = max(200.0, 0.6 * med)                   # scale to file loudness
   zc_ok  = zc > int(FRAME_SAMPLES * 0.004)         # ~0.4% of samples crossing
 
   mask = (rms > rms_on) & zc_ok
   return mask
 
-def goertzel_frame(frame):
-  """Compute 24-bin Goertzel log-power for one frame."""
+def goertzel_batch(frames, out=None):
+  """Compute 24-bin Goertzel log-power for every frame at once -> [T, 24].
+
+  Results are written into `out` ([T, KWS_NBINS] float32) when given.
+  """
+  if out is None:
+    out = np.empty((frames.shape[0], KWS_NBINS), dtype=np.float32)
+  xw, re, im = _scratch(frames.shape[0])
   # Match device: remove per-frame mean, then apply Hann.
-  x = (frame - frame.mean()) * HANN
-  out = np.zeros((KWS_NBINS,), dtype=np.float32)
-  for b in range(KWS_NBINS):
-    w = GOERTZEL_W[b]
-    s_prev = 0.0
-    s_prev2 = 0.0
-    for n in range(FRAME_SAMPLES):
-      s = x[n] + w*s_prev - s_prev2
-      s_prev2 = s_prev
-      s_prev = s
-    power = s_prev2*s_prev2 + s_prev*s_prev - w*s_prev*s_prev2
-    out[b] = np.log(1e-3 + power)
+  np.subtract(frames, frames.mean(axis=1, keepdims=True, dtype=np.float32), out=xw)
+  np.multiply(xw, HANN, out=xw)
+  # Project onto the bin basis: two GEMMs for the whole utterance.
+  np.matmul(xw, DFT_COS, out=re)
+  np.matmul(xw, DFT_SIN, out=im)
+  # log(1e-3 + re^2 + im^2), computed in place
+  np.multiply(re, re, out=re)
+  np.multiply(im, im, out=im)
+  np.add(re, im, out=re)
+  re += 1e-3
+  np.log(re, out=out)
   return out
 
 def extract_feats_from_wav(wav_path):
@@ -207,9 +241,10 @@ def extract_feats_from_wav(wav_path):
     return None
 
   vad = vad_mask(frames)
-  if vad.sum() >= 6:
-    first = int(np.where(vad)[0][0])
-    last = int(np.where(vad)[0][-1])
+  voiced = np.flatnonzero(vad)  # single scan of the mask
+  if voiced.size >= 6:
+    first = int(voiced[0])
+    last = int(voiced[-1])
     start_idx = max(0, first - VAD_PREROLL_FR)
     end_idx = min(frames.shape[0], last + VAD_POSTROLL_FR + 1)
     use_frames = frames[start_idx:end_idx]
@@ -219,8 +254,13 @@ def extract_feats_from_wav(wav_path):
     half = 30  # ~0.3 s each side at 10 ms hop
     use_frames = frames[max(0, center - half):min(frames.shape[0], center + half)]
 
+  # CMVN below uses ddof=1; a single frame would turn the template into NaNs.
+  if use_frames.shape[0] < 2:
+    return None
+
   # compute features per frame
-  feats = np.stack([goertzel_frame(f) for f in use_frames], axis=0)  # [T, 24]
+  feats = np.empty((use_frames.shape[0], KWS_NBINS), dtype=np.float32)  # [T, 24]
+  goertzel_batch(use_frames, out=feats)
 
   # CMVN per utterance
   mu = feats.mean(axis=0, keepdims=True)
@@ -234,100 +274,130 @@ def extract_feats_from_wav(wav_path):
 
   return feats.astype(np.float32)
 
+def quantize_template(tpl):
+  """Quantize a [T,24] template to int8; returns (q, inv_scale) with tpl ~= q * inv_scale."""
+  scale = 127.0 / max(1e-6, float(np.max(np.abs(tpl))))
+  q = np.clip(np.round(tpl * scale), -127, 127).astype(np.int8)
+  return q, 1.0 / scale
+
 def write_header(out_path, bank):
   """
   bank: dict token_id -> list of np.array [T,24]
   Emit C header with PROGMEM arrays and a small metadata table.
   """
+  # Build the whole file in memory and write it once at the end.
+  parts = []
+  emit = parts.append
+  emit("// Auto-generated by generate_kws_templates.py\n")
+  emit("// Do not edit by hand.\n\n")
+  emit("#pragma once\n#include <Arduino.h>\n\n")
+  emit("// Must match firmware constants:\n")
+  emit("#define KWS_NBINS 24\n\n")
+  emit(f"#define KWS_TOKEN_COUNT {len(TOKEN_LIST)}\n")
+  emit("#define KWS_MAX_TEMPLATES 3\n\n")
+
+  # Emit per-template arrays
+  tpl_names = []
+  for tid in sorted(bank.keys()):
+    tpl_list = bank[tid]
+    for j, tpl in enumerate(tpl_list):
+      name = f"kws_tpl_{tid}_{j}"
+      # int8 with a per-template scale: 1/4 the flash of float32
+      q, inv_scale = quantize_template(tpl)
+      tpl_names.append((tid, j, name, tpl.shape[0], inv_scale))
+      emit(f"// token {tid} ({TOKEN_LIST[tid]}), template {j}, T={tpl.shape[0]}, scale={inv_scale:.9g}\n")
+      emit(f"static const int8_t {name}[] PROGMEM = {{\n")
+      # write as rows of 24; savetxt does one %-format per row, not per value
+      buf = io.StringIO()
+      np.savetxt(buf, q.reshape(-1, KWS_NBINS), fmt="%d", delimiter=", ", newline=",\n  ")
+      emit("  " + buf.getvalue().rstrip(" "))
+      emit("};\n\n")
+
+  # For each token, write a small table of template pointers, lengths and scales
+  emit("// Per-token template tables\n")
+  for tid in range(len(TOKEN_LIST)):
+    tpls = [x for x in tpl_names if x[0] == tid]
+    emit(f"static const uint16_t kws_token_{tid}_T[] PROGMEM = {{")
+    emit(", ".join(str(T) for (_,_,_,T,_) in tpls) if tpls else "")
+    emit("};\n")
+    emit(f"static const float kws_token_{tid}_scale[] PROGMEM = {{")
+    emit(", ".join(f"{sc:.9g}f" for (_,_,_,_,sc) in tpls) if tpls else "")
+    emit("};\n")
+    emit(f"static const int8_t* const kws_token_{tid}_ptrs[] PROGMEM = {{")
+    emit(", ".join(name for (_,_,name,_,_) in tpls) if tpls else "")
+    emit("};\n\n")
+
+  # Summary table so firmware can iterate tokens
+  emit("// Summary table\n")
+  emit(f"static const uint16_t kws_token_counts[] PROGMEM = {{\n  ")
+  counts = []
+  for tid in range(len(TOKEN_LIST)):
+    c = sum(1 for x in tpl_names if x[0] == tid)
+    counts.append(c)
+  emit(", ".join(str(c) for c in counts))
+  emit("\n};\n\n")
+
+  # function to copy from PROGMEM into runtime bank (malloc); templates are
+  # dequantized back to float so the firmware's DTW is unchanged
+  emit("// Loader to copy PROGMEM templates into runtime KWS bank\n")
+  emit("extern \"C\" {\n")
+  emit("  typedef struct { uint16_t T; float* feats; } KwsTemplate;\n")
+  emit("  typedef struct { uint8_t n; KwsTemplate tpl[3]; } KwsBank; // KWS_MAX_TEMPLATES=3 in firmware\n")
+  emit("  extern KwsBank g_bank[]; // defined in main.ino\n")
+  emit("}\n\n")
+
+  emit("static void kws_load_from_progmem() {\n")
+  emit("  for (int tid=0; tid<KWS_TOKEN_COUNT; ++tid) {\n")
+  emit("    uint16_t count = pgm_read_word(&kws_token_counts[tid]);\n")
+  emit("    KwsBank &bk = g_bank[tid];\n")
+  emit("    bk.n = 0;\n")
+  emit("    if (!count) continue;\n")
+  emit("    // read T table pointer\n")
+  emit("    const uint16_t* Ttbl;\n")
+  emit("    const float* Stbl;\n")
+  emit("    const int8_t* const* Ptbl;\n")
+  # We have to select the token-specific arrays by switch (C++ can’t index symbol names)
+  emit("    switch(tid){\n")
+  for tid in range(len(TOKEN_LIST)):
+    emit(f"      case {tid}: Ttbl = kws_token_{tid}_T; Stbl = kws_token_{tid}_scale; Ptbl = kws_token_{tid}_ptrs; break;\n")
+  emit("      default: Ttbl=nullptr; Stbl=nullptr; Ptbl=nullptr; break;\n")
+  emit("    }\n")
+  emit("    if (!Ttbl || !Stbl || !Ptbl) continue;\n")
+  emit("    uint16_t use = count > 3 ? 3 : count; // cap to firmware slots\n")
+  emit("    for (uint16_t j=0; j<use; ++j){\n")
+  emit("      uint16_t T = pgm_read_word(&Ttbl[j]);\n")
+  emit("      float scale = pgm_read_float(&Stbl[j]);\n")
+  emit("      const int8_t* p = (const int8_t*)pgm_read_ptr(&Ptbl[j]);\n")
+  emit("      size_t n = (size_t)T * KWS_NBINS;\n")
+  emit("      float* buf = (float*) malloc(n * sizeof(float));\n")
+  emit("      if(!buf) continue;\n")
+  emit("      for (size_t i=0; i<n; ++i) buf[i] = (int8_t)pgm_read_byte(&p[i]) * scale;\n")
+  emit("      bk.tpl[j].T = T;\n")
+  emit("      bk.tpl[j].feats = buf;\n")
+  emit("      bk.n++;\n")
+  emit("    }\n")
+  emit("  }\n")
+  emit("}\n")
+
   with open(out_path, "w") as f:
-    f.write("// Auto-generated by generate_kws_templates.py\n")
-    f.write("// Do not edit by hand.\n\n")
-    f.write("#pragma once\n#include <Arduino.h>\n\n")
-    f.write("// Must match firmware constants:\n")
-    f.write("#define KWS_NBINS 24\n\n")
-    f.write(f"#define KWS_TOKEN_COUNT {len(TOKEN_LIST)}\n")
-    f.write("#define KWS_MAX_TEMPLATES 3\n\n")
-
-    # Emit per-template arrays
-    tpl_names = []
-    for tid in sorted(bank.keys()):
-      tpl_list = bank[tid]
-      for j, tpl in enumerate(tpl_list):
-        name = f"kws_tpl_{tid}_{j}"
-        tpl_names.append((tid, j, name, tpl.shape[0]))
-        flat = tpl.reshape(-1)
-        f.write(f"// token {tid} ({TOKEN_LIST[tid]}), template {j}, T={tpl.shape[0]}\n")
-        f.write(f"static const float {name}[] PROGMEM = {{\n")
-        # write as rows of 24
-        idx = 0
-        for t in range(tpl.shape[0]):
-          row = ", ".join(f"{float(v):.6f}" for v in tpl[t])
-          f.write(f"  {row},\n")
-          idx += KWS_NBINS
-        f.write("};\n\n")
-
-    # For each token, write a small table of template pointers and lengths
-    f.write("// Per-token template tables\n")
-    for tid in range(len(TOKEN_LIST)):
-      tpls = [x for x in tpl_names if x[0] == tid]
-      f.write(f"static const uint16_t kws_token_{tid}_T[] PROGMEM = {{")
-      f.write(", ".join(str(T) for (_,_,_,T) in tpls) if tpls else "")
-      f.write("};\n")
-      f.write(f"static const float* const kws_token_{tid}_ptrs[] PROGMEM = {{")
-      f.write(", ".join(name for (_,_,name,_) in tpls) if tpls else "")
-      f.write("};\n\n")
-
-    # Summary table so firmware can iterate tokens
-    f.write("// Summary table\n")
-    f.write(f"static const uint16_t kws_token_counts[] PROGMEM = {{\n  ")
-    counts = []
-    for tid in range(len(TOKEN_LIST)):
-      c = sum(1 for x in tpl_names if x[0] == tid)
-      counts.append(c)
-    f.write(", ".join(str(c) for c in counts))
-    f.write("\n};\n\n")
-
-    # function to copy from PROGMEM into runtime bank (malloc)
-    f.write("// Loader to copy PROGMEM templates into runtime KWS bank\n")
-    f.write("extern \"C\" {\n")
-    f.write("  typedef struct { uint16_t T; float* feats; } KwsTemplate;\n")
-    f.write("  typedef struct { uint8_t n; KwsTemplate tpl[3]; } KwsBank; // KWS_MAX_TEMPLATES=3 in firmware\n")
-    f.write("  extern KwsBank g_bank[]; // defined in main.ino\n")
-    f.write("}\n\n")
-
-    f.write("static void kws_load_from_progmem() {\n")
-    f.write("  for (int tid=0; tid<KWS_TOKEN_COUNT; ++tid) {\n")
-    f.write("    uint16_t count = pgm_read_word(&kws_token_counts[tid]);\n")
-    f.write("    KwsBank &bk = g_bank[tid];\n")
-    f.write("    bk.n = 0;\n")
-    f.write("    if (!count) continue;\n")
-    f.write("    // read T table pointer\n")
-    f.write("    const uint16_t* Ttbl;\n")
-    f.write("    const float* const* Ptbl;\n")
-    # We have to select the token-specific arrays by switch (C++ can’t index symbol names)
-    f.write("    switch(tid){\n")
-    for tid in range(len(TOKEN_LIST)):
-      f.write(f"      case {tid}: Ttbl = kws_token_{tid}_T; Ptbl = kws_token_{tid}_ptrs; break;\n")
-    f.write("      default: Ttbl=nullptr; Ptbl=nullptr; break;\n")
-    f.write("    }\n")
-    f.write("    if (!Ttbl || !Ptbl) continue;\n")
-    f.write("    uint16_t use = count > 3 ? 3 : count; // cap to firmware slots\n")
-    f.write("    for (uint16_t j=0; j<use; ++j){\n")
-    f.write("      uint16_t T = pgm_read_word(&Ttbl[j]);\n")
-    f.write("      const float* p = (const float*)pgm_read_ptr(&Ptbl[j]);\n")
-    f.write("      size_t bytes = (size_t)T * KWS_NBINS * sizeof(float);\n")
-    f.write("      float* buf = (float*) malloc(bytes);\n")
-    f.write("      if(!buf) continue;\n")
-    f.write("      memcpy_P(buf, p, bytes);\n")
-    f.write("      bk.tpl[j].T = T;\n")
-    f.write("      bk.tpl[j].feats = buf;\n")
-    f.write("      bk.n++;\n")
-    f.write("    }\n")
-    f.write("  }\n")
-    f.write("}\n")
+    f.write("".join(parts))
 
   print(f"[OK] Wrote {out_path}")
 
+def scan_wav_dirs(root):
+  """Map each subfolder name of root -> sorted *.wav paths, in one scan."""
+  all_wavs = {}
+  if not os.path.isdir(root):
+    return all_wavs
+  with os.scandir(root) as it:
+    for d in it:
+      if not d.is_dir():
+        continue
+      with os.scandir(d.path) as files:
+        all_wavs[d.name] = sorted(e.path for e in files
+                                  if e.name.endswith(".wav") and not e.name.startswith(".") and e.is_file())
+  return all_wavs
+
 def main():
   ap = argparse.ArgumentParser()
   ap.add_argument("--wavs", required=True, help="Root folder containing per-token subfolders")
@@ -337,32 +407,39 @@ def main():
   bank = {}  # tid -> [feats...]
   missing = []
 
+  all_wavs = scan_wav_dirs(args.wavs)
+
   def wavs_for_token(token: str):
     """Return (wav_paths, used_subdir). Tries token dir + alias dirs."""
     candidates = [token] + TOKEN_DIR_ALIASES.get(token, [])
     for sub in candidates:
-      token_dir = os.path.join(args.wavs, sub)
-      wavs = sorted(glob.glob(os.path.join(token_dir, "*.wav")))
+      wavs = all_wavs.get(sub)
       if wavs:
         return wavs, sub
     return [], None
 
+  jobs = []  # (token, wav_path)
   for token in TOKEN_LIST:
     wavs, used_subdir = wavs_for_token(token)
     if not wavs:
       missing.append(token)
       continue
-    for w in wavs:
-      feats = extract_feats_from_wav(w)
-      if feats is None:
-        print(f"[WARN] Skipped (VAD too short?) {w}")
-        continue
-      tid = TOKEN_TO_ID[token]
-      bank.setdefault(tid, []).append(feats)
+    jobs.extend((token, w) for w in wavs)
 
     if used_subdir and used_subdir != token:
       print(f"[INFO] Using '{used_subdir}/' WAVs for token '{token}'")
 
+  # Each WAV is independent: extract features across all cores.
+  with ProcessPoolExecutor() as ex:
+    results = list(ex.map(extract_feats_from_wav, [w for (_, w) in jobs]))
+
+  for (token, w), feats in zip(jobs, results):
+    if feats is None:
+      print(f"[WARN] Skipped (VAD too short?) {w}")
+      continue
+    tid = TOKEN_TO_ID[token]
+    bank.setdefault(tid, []).append(feats)
+
   if missing:
     print("[INFO] No WAVs for:", ", ".join(missing))
 